@@ -1,7 +1,3 @@
 python src/aggregate.py
 
-python src/run_training.py --config-name=run1
-python src/run_training.py --config-name=run2
-python src/run_training.py --config-name=run3
-python src/run_training.py --config-name=run4
-python src/run_training.py --config-name=run5
\ No newline at end of file
+python src/run_parallel.py
\ No newline at end of file
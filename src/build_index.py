@@ -0,0 +1,33 @@
+"""
+Fit centroids of time of activity index on train users and save them for submission.
+"""
+
+import sys
+
+import numpy as np
+
+from neighbours import EMBEDDING_BUCKETS, fit_centroids, save_centroids, time_embeddings
+from store import load_aggregates
+
+
+def main():
+
+    # python src/build_index.py [num_lists] from repository root
+    num_lists = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+    transactions_data = load_aggregates('./data/transactions', list(EMBEDDING_BUCKETS))
+    clickstream_data = load_aggregates('./data/clickstream', list(EMBEDDING_BUCKETS))
+
+    bank_vectors = time_embeddings(transactions_data, 'trans',
+                                   transactions_data['hour'].index)
+    rtk_vectors = time_embeddings(clickstream_data, 'click',
+                                  clickstream_data['hour'].index)
+    centroids = fit_centroids(np.vstack((bank_vectors, rtk_vectors)), num_lists)
+    print('centroids', centroids.shape)
+
+    save_centroids('./submit/data/time_index.npy', centroids)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -2,81 +2,101 @@
 Make predictions and calculate metrics.
 """
 
+import time
+
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from scoring import batch_size_for_budget, feature_matrix, pair_buffer, pair_features, top_k
+
 
-def make_predictions(clf, test, df_trans, df_click, batch_size=20):
+def make_predictions(clf, test, df_trans, df_click, batch_size=20, memory_budget=None):
     
-    preds = test.bank.to_frame().reset_index(drop=True)
-    preds['rtk'] = preds.bank.apply(lambda x: test.rtk.tolist())
+    banks = np.array(test.bank.tolist(), dtype=object)
+    rtks = np.array(test.rtk.tolist(), dtype=object)
+    trans_features = feature_matrix(df_trans, banks)
+    click_features = feature_matrix(df_click, rtks)
+    if memory_budget is not None:
+        batch_size = batch_size_for_budget(
+            len(rtks), [trans_features.shape[1] + click_features.shape[1]], memory_budget)
+    buffer = pair_buffer(trans_features, click_features, batch_size)
     
-    num_of_batches = int((len(preds))/batch_size)+1
+    num_of_batches = int((len(banks))/batch_size)+1
     final_preds = []
 
+    # true rtk of bank row i is rtks[i], rtk are compared by codes of their values
+    rtk_codes = pd.factorize(rtks)[0]
+    num_hits, sum_reciprocal_rank = 0, 0.
+
     with tqdm(range(num_of_batches)) as pbar:
         for i in pbar:
 
-            bank_ids = preds.bank[(i*batch_size):((i+1)*batch_size)]
-
-            preds_part = preds[preds.bank.isin(bank_ids)].explode('rtk')
-            preds_part = preds_part.merge(df_trans, how='left', left_on='bank', right_index=True) \
-                .merge(df_click, how='left', left_on='rtk', right_index=True)
-
-            preds_part = preds_part.sort_values('bank')
-            X = preds_part.drop(['bank', 'rtk'], axis=1).values
+            bank_rows = np.arange(i*batch_size, min((i+1)*batch_size, len(banks)))
+            if len(bank_rows) == 0:
+                continue
 
-            preds_part['proba'] = clf.predict(X)
-            preds_part = preds_part[['bank', 'rtk', 'proba']]
+            start_time = time.time()
+            X = pair_features(trans_features, click_features, bank_rows, buffer)
+            scores = clf.predict(X).reshape(len(bank_rows), len(rtks))
+            top = top_k(scores, 100)
+            rows_per_sec = int(len(X) / (time.time() - start_time))
 
-            preds_part = preds_part.sort_values(
-                by=['bank', 'proba'],ascending=False).reset_index(drop=True)
-            preds_part = preds_part.pivot_table(index='bank', values='rtk', aggfunc=list)
-            preds_part['rtk'] = preds_part['rtk'].apply(lambda x: x[:100])
-            preds_part = preds_part.reset_index()
+            order = np.argsort(banks[bank_rows], kind='stable')
+            preds_part = pd.DataFrame({'bank': banks[bank_rows][order],
+                                       'rtk': [rtks[row].tolist() for row in top[order]]})
             final_preds.append(preds_part)
 
-            current_preds = pd.concat(final_preds)
-            r1, mrr, precision = calc_metrics(current_preds, test)
-            pbar.set_postfix(r1=r1)
+            # running metrics are updated with current batch only
+            hits, reciprocal_ranks = rank_metrics(rtk_codes[top], rtk_codes[bank_rows])
+            num_hits += hits.sum()
+            sum_reciprocal_rank += reciprocal_ranks.sum()
+            precision = num_hits / (bank_rows[-1] + 1)
+            mrr = sum_reciprocal_rank / (bank_rows[-1] + 1)
+            pbar.set_postfix(r1=calc_r1(precision, mrr), rows_per_sec=rows_per_sec)
 
     return pd.concat(final_preds)
 
 
 def calc_metrics(preds, test):
-    
+
     final = pd.merge(preds, test.rename(columns={'rtk': 'ytrue'}))
-    final['precision'] = final.apply(apply_precision, axis=1)
-    final['mrr'] = final.apply(apply_mrr, axis=1)
-    
-    precision = final.precision.mean()
-    mrr = final.mrr.mean()
+
+    # flatten ranked lists and compare values with true rtk of their rows
+    lengths = final.rtk.str.len().values
+    offsets = np.cumsum(lengths) - lengths
+    rows = np.repeat(np.arange(len(final)), lengths)
+    positions = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+    values = np.empty(lengths.sum(), dtype=object)
+    values[:] = [rtk for ranked in final.rtk for rtk in ranked]
+    matches = (values == final.ytrue.values[rows]) & (positions < 100)
+
+    first_positions = np.full(len(final), np.inf)
+    np.minimum.at(first_positions, rows[matches], positions[matches])
+
+    precision = np.isfinite(first_positions).mean()
+    mrr = (1 / (first_positions + 1)).mean()
     r1 = calc_r1(precision, mrr)
 
     return r1, mrr, precision
 
 
-def apply_precision(row):
-    
-    if row.ytrue in row.rtk[:100]:
-        return 1
-    else:
-        return 0
+def rank_metrics(ranks, ytrue):
+    """
+    Hit indicators and reciprocal ranks of ytrue (num_banks,) codes in
+    rows of (num_banks, k) ranked codes, reciprocal rank is 0 if there is no hit.
+    """
 
+    matches = ranks == ytrue[:, None]
+    hits = matches.any(axis=1)
+    reciprocal_ranks = np.where(hits, 1 / (matches.argmax(axis=1) + 1), 0.)
 
-def apply_mrr(row):
-    
-    try:
-        mrr = 1/(row.rtk[:100].index(row.ytrue) + 1)
-    except ValueError:
-        mrr = 0
-    
-    return mrr
+    return hits, reciprocal_ranks
 
 
 def calc_r1(precision, mrr):
-    
-    try:
-        return 2 * precision * mrr / (precision + mrr)
-    except ZeroDivisionError:
+
+    if precision + mrr == 0:
         return 0
+
+    return 2 * precision * mrr / (precision + mrr)
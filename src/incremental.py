@@ -0,0 +1,146 @@
+"""
+Incremental update of aggregates with new slices of events and persisted mergeable state.
+"""
+
+import gc
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from aggregate import (CLICKSTREAM_DTYPE, TRANSACTIONS_DTYPE, clickstream_state,
+                       finalize_clickstream, finalize_transactions, merge_states,
+                       read_events, transactions_state)
+from store import MANIFEST, load_aggregates, save_aggregates
+
+
+# distinct (user, key, date) and (user, date, slot) sets are partitioned by periods of days
+PARTITION_DAYS = 7
+# marks staging directory of update with all partitions written
+COMPLETE = 'complete'
+
+
+def update_transactions(transactions_path, state_path, chunksize=None):
+    """
+    Fold transactions of new slice into state saved in state_path (created
+    if missing) and return aggregates of all transactions seen so far.
+    Slice must contain only new events, aggregates are the same as of full
+    recompute up to last float32 digits of amount sums.
+    """
+
+    state = update_state(transactions_path, TRANSACTIONS_DTYPE, 'transaction_dttm',
+                         transactions_state, state_path, chunksize)
+
+    return finalize_transactions(state)
+
+
+def update_clickstream(clickstream_path, state_path, chunksize=None):
+    """
+    Fold clickstream of new slice into state saved in state_path (created
+    if missing) and return aggregates of all clickstream seen so far.
+    """
+
+    state = update_state(clickstream_path, CLICKSTREAM_DTYPE, 'timestamp',
+                         clickstream_state, state_path, chunksize)
+
+    return finalize_clickstream(state)
+
+
+def update_state(path, dtype, time_column, state_func, state_path, chunksize=None):
+    """
+    Merge state of events in path into partitioned state saved in state_path
+    and return whole state. Only partitions touched by events are loaded,
+    merged and rewritten.
+    """
+
+    # partitions of an update are fully written to staging directory first,
+    # update interrupted after that is completed on the next call
+    staging_path = f'{state_path}.update'
+    if os.path.exists(os.path.join(staging_path, COMPLETE)):
+        move_partitions(staging_path, state_path)
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path)
+
+    state = None
+    for events in read_events(path, dtype, time_column, chunksize):
+        state = merge_states(state, state_func(events))
+        del events
+        gc.collect()
+
+    for key, frame in state.items():
+        partitions = state_partitions(key, frame)
+        for partition in np.unique(partitions):
+            partition_path = os.path.join(key, str(partition))
+            merged = {key: frame[partitions == partition]}
+            if os.path.exists(os.path.join(state_path, partition_path, MANIFEST)):
+                merged = merge_states(load_aggregates(os.path.join(state_path, partition_path)),
+                                      merged)
+            save_aggregates(merged, os.path.join(staging_path, partition_path))
+    del state
+    gc.collect()
+
+    open(os.path.join(staging_path, COMPLETE), 'w').close()
+    move_partitions(staging_path, state_path)
+    shutil.rmtree(staging_path)
+
+    return load_state(state_path)
+
+
+def state_partitions(key, frame):
+    """
+    Partition of every row of state frame: distinct sets are partitioned by
+    PARTITION_DAYS periods of date, week groups by week and grouped sums
+    are kept in one partition.
+    """
+
+    if key == 'by_week':
+        return frame.index.get_level_values('week').values
+    if 'date' in frame.columns:
+        return frame.date.values // PARTITION_DAYS
+
+    return np.zeros(len(frame), dtype='int64')
+
+
+def move_partitions(staging_path, state_path):
+    """Replace partitions of state with written ones, partitions already moved are skipped."""
+
+    for key in os.listdir(staging_path):
+        if key == COMPLETE:
+            continue
+        os.makedirs(os.path.join(state_path, key), exist_ok=True)
+        for partition in os.listdir(os.path.join(staging_path, key)):
+            partition_path = os.path.join(state_path, key, partition)
+            if os.path.exists(partition_path):
+                shutil.rmtree(partition_path)
+            os.rename(os.path.join(staging_path, key, partition), partition_path)
+
+
+def load_state(state_path):
+    """Whole state from all partitions, grouped frames are sorted as after merge."""
+
+    state = {}
+    for key in sorted(os.listdir(state_path)):
+        partitions = [load_aggregates(os.path.join(state_path, key, partition))[key]
+                      for partition in sorted(os.listdir(os.path.join(state_path, key)), key=int)]
+        frame = pd.concat(partitions)
+        if isinstance(frame.index, pd.MultiIndex):
+            frame = frame.sort_index()
+        else:
+            frame = frame.reset_index(drop=True)
+        state[key] = frame
+
+    return state
+
+
+if __name__ == '__main__':
+
+    # python src/incremental.py transactions_slice.csv clickstream_slice.csv
+    transactions_path, clickstream_path = sys.argv[1:]
+
+    transactions = update_transactions(transactions_path, './data/state/transactions')
+    save_aggregates(transactions, './data/transactions')
+
+    clickstream = update_clickstream(clickstream_path, './data/state/clickstream')
+    save_aggregates(clickstream, './data/clickstream')
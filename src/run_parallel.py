@@ -0,0 +1,85 @@
+"""
+Train models of several run configs concurrently with core budget split between runs.
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hydra import compose, initialize
+
+from run_training import load_data, train_run
+
+
+# data is loaded once in main process and shared with forked workers
+_DATA = None
+
+
+def main():
+
+    # python src/run_parallel.py [num_cores] [run1 run2 ...]
+    num_cores = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    run_names = sys.argv[2:] or [f'run{i}' for i in range(1, 6)]
+
+    thread_counts = split_cores(num_cores, len(run_names))
+    with initialize(config_path='config', version_base=None):
+        # every run logs to its own catboost train dir
+        configs = [compose(config_name=name, overrides=[
+                       f'train_params.thread_count={thread_count}',
+                       f'+catboost_params.train_dir=catboost_info/{name}'])
+                   for name, thread_count in zip(run_names, thread_counts)]
+    for config in configs:
+        os.makedirs(config.catboost_params.train_dir, exist_ok=True)
+
+    global _DATA
+    _DATA = load_data(
+        sorted({key for config in configs
+                for key in [config.trans_data, *config.trans_time_features]}),
+        sorted({key for config in configs
+                for key in [config.click_data, *config.click_time_features]}))
+
+    start_time = time.time()
+    num_jobs = min(len(configs), num_cores)
+    with ProcessPoolExecutor(num_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+
+        futures = {executor.submit(timed_run, config): i for i, config in enumerate(configs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            wall_time, cpu_time = future.result()
+            print(f'{run_names[i]}: {thread_counts[i]} threads, wall time {wall_time:.0f}s, '
+                  f'cpu utilization {cpu_time / (wall_time * thread_counts[i]):.0%}')
+
+    print(f'{len(configs)} runs on {num_cores} cores, '
+          f'total wall time {time.time() - start_time:.0f}s')
+
+
+def split_cores(num_cores, num_runs):
+    """
+    Thread count of every run, runs are trained in min(num_runs, num_cores)
+    concurrent slots and cores are split evenly between slots.
+    """
+
+    num_slots = min(num_runs, num_cores)
+
+    return [num_cores // num_slots + (i % num_slots < num_cores % num_slots)
+            for i in range(num_runs)]
+
+
+def timed_run(config):
+    """Train run in worker process, return its wall time and cpu time of all its threads."""
+
+    start_time = time.time()
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    train_run(config, *_DATA)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime)
+
+    return time.time() - start_time, cpu_time
+
+
+if __name__ == '__main__':
+
+    main()
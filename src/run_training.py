@@ -10,6 +10,7 @@ from hydra.utils import to_absolute_path
 from omegaconf import OmegaConf
 
 from preprocess import click_preprocess, trans_preprocess
+from store import load_aggregates
 from train import training_with_resampling
 
 
@@ -18,10 +19,17 @@ def main(config):
 
     print(OmegaConf.to_yaml(config))
 
-    with open(to_absolute_path("data/transactions.pkl"), "rb") as file_:
-        transactions_data = pickle.load(file_)
-    with open(to_absolute_path("data/clickstream.pkl"), "rb") as file_:
-        clickstream_data = pickle.load(file_)
+    transactions_data, clickstream_data, click_categories, matching = load_data(
+        [config.trans_data, *config.trans_time_features],
+        [config.click_data, *config.click_time_features])
+    train_run(config, transactions_data, clickstream_data, click_categories, matching)
+
+
+def load_data(trans_keys, click_keys):
+    """Aggregates with given keys, click categories and train matching."""
+
+    transactions_data = load_aggregates(to_absolute_path('data/transactions'), trans_keys)
+    clickstream_data = load_aggregates(to_absolute_path('data/clickstream'), click_keys)
 
     click_categories = pd.read_csv(to_absolute_path('data/click_categories.csv'))
     click_categories.fillna('NaN', inplace=True)
@@ -29,6 +37,11 @@ def main(config):
     matching = pd.read_csv(to_absolute_path('data/train_matching.csv'))
     matching['target'] = 1
 
+    return transactions_data, clickstream_data, click_categories, matching
+
+
+def train_run(config, transactions_data, clickstream_data, click_categories, matching):
+    """Preprocess features of run config, train model and save it to submit folder."""
 
     df_click = click_preprocess(clickstream_data[config.click_data], click_categories,
                                 **config.click_params)
@@ -7,20 +7,33 @@ import pandas as pd
 
 
 def sample_negative_examples(data, sample_size=10, random_state=42):
+    """
+    Positive pairs of data (without rtk '0') with sample_size random negative pairs per bank
+    row, pairs are deduplicated and negatives which are positive pairs get target 1.
+    """
+
+    rng = np.random.default_rng(random_state)
+    bank_codes, banks = pd.factorize(data.bank, sort=True)
+    rtk_codes, rtks = pd.factorize(data.rtk, sort=True)
+    bank_codes = bank_codes.astype('int32')
+    rtk_codes = rtk_codes.astype('int32')
+    positive = (data.rtk != '0').values
+
+    # every bank row is paired with sample_size rtk, every rtk is used equal number of times
+    bank_sample = rng.permutation(np.tile(bank_codes, sample_size))
+    num_repeats = int(np.ceil(len(bank_sample) / positive.sum()))
+    rtk_sample = rng.permutation(np.tile(rtk_codes[positive], num_repeats))[:len(bank_sample)]
+
+    # pairs are packed into int64 keys, unique keys are sorted by bank and rtk
+    positive_keys = bank_codes[positive].astype('int64') * len(rtks) + rtk_codes[positive]
+    sample_keys = bank_sample.astype('int64') * len(rtks) + rtk_sample
+    keys = np.unique(np.concatenate((positive_keys, sample_keys)))
+    target = np.isin(keys, positive_keys).astype('int64')
+
+    order = rng.permutation(len(keys))
+    keys = keys[order]
+    final_df = pd.DataFrame({'bank': banks.values[keys // len(rtks)],
+                             'rtk': rtks.values[keys % len(rtks)],
+                             'target': target[order]})
 
-    bank_sample = pd.concat([data.bank] * sample_size).sample(
-            frac=1, replace=False, random_state=random_state).reset_index(drop=True)
-    rtk = data.rtk[data.rtk != '0']
-    size_ratio = len(data) / len(rtk)
-    rtk_sample = pd.concat([rtk] * int(np.ceil(sample_size * size_ratio))).sample(
-            frac=1, replace=False, random_state=random_state + 1).reset_index(drop=True)
-    sample = pd.DataFrame({'bank': bank_sample,
-                            'rtk': rtk_sample.iloc[:len(bank_sample)],
-                            'target': 0})
-            
-    final_df = pd.concat([data, sample])
-    final_df = final_df[final_df.rtk != '0']
-    final_df = final_df.groupby(['bank', 'rtk']).target.max().reset_index()
-    final_df = final_df.sample(frac=1, replace=False, random_state=random_state)
-    
     return final_df
@@ -0,0 +1,111 @@
+"""
+Build model inputs for (bank, rtk) candidate pairs with array gathers and rank scores.
+"""
+
+import numpy as np
+
+
+def feature_matrix(df, ids, columns=None):
+    """
+    C-contiguous float32 matrix of df rows in order of ids (row positions are mapped once),
+    rows of ids missing in df are NaN as after left merge. If columns are given,
+    matrix columns are in this order and columns missing in df are zero.
+    """
+
+    if columns is None:
+        columns = df.columns
+    positions = df.index.get_indexer(ids)
+    column_positions = df.columns.get_indexer(columns)
+
+    matrix = np.zeros((len(ids), len(columns)), dtype='float32')
+    matrix[positions == -1] = np.nan
+    found = np.flatnonzero(positions != -1)
+    found_columns = np.flatnonzero(column_positions != -1)
+    matrix[np.ix_(found, found_columns)] = df.iloc[
+        positions[found], column_positions[found_columns]].to_numpy(dtype='float32')
+
+    return matrix
+
+
+def pair_features(trans_features, click_features, bank_rows, out=None, rtk_rows=None):
+    """
+    Features of all pairs of given banks with all rtk: each bank row is repeated
+    for every rtk and rtk rows are tiled for every bank, trans features go first.
+    If rtk_rows (num_banks, num_candidates) are given, every bank is paired
+    only with its own candidate rtk rows.
+    If out is given it is used as preallocated (batch_size, num_rtk, num_features) buffer.
+    """
+
+    num_trans = trans_features.shape[1]
+    num_rtk = click_features.shape[0] if rtk_rows is None else rtk_rows.shape[1]
+    shape = (len(bank_rows), num_rtk, num_trans + click_features.shape[1])
+    if out is None:
+        out = np.empty(shape, dtype='float32')
+    else:
+        out = out[:len(bank_rows), :num_rtk]
+
+    out[:, :, :num_trans] = trans_features[bank_rows][:, None, :]
+    if rtk_rows is None:
+        out[:, :, num_trans:] = click_features[None, :, :]
+    else:
+        out[:, :, num_trans:] = click_features[rtk_rows]
+
+    return out.reshape(-1, shape[2])
+
+
+def pair_buffer(trans_features, click_features, batch_size, num_candidates=None):
+    """Preallocated buffer for pair_features."""
+
+    if num_candidates is None:
+        num_candidates = click_features.shape[0]
+
+    return np.empty((batch_size, num_candidates,
+                     trans_features.shape[1] + click_features.shape[1]), dtype='float32')
+
+
+def top_k(scores, k=100):
+    """
+    Column indices of k highest scores in each row of (num_banks, num_candidates)
+    score matrix ordered by descending score, equal scores keep candidates order.
+    """
+
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top.sort(axis=1)
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+
+    return np.take_along_axis(top, order, axis=1)
+
+
+def batch_size_for_budget(num_candidates, widths, memory_budget=None, rows_per_batch=None,
+                          other_stages=()):
+    """
+    Number of banks per batch. If rows_per_batch is given batch has about that many
+    (bank, candidate) rows, otherwise it is chosen so that float32 pair buffers of all models
+    (feature widths), copy of the widest one made by model and float64 scores fit into memory_budget bytes.
+    other_stages are (num_candidates, widths) of scoring stages with buffers of the same
+    number of banks alive at the same time, all stages share memory_budget.
+    """
+
+    stages = [(num_candidates, widths), *other_stages]
+    if rows_per_batch is not None:
+        return max(1, rows_per_batch // max(n for n, _ in stages))
+
+    bytes_per_bank = sum((4 * (sum(widths) + max(widths)) + 8 * (len(widths) + 1)) * n
+                         for n, widths in stages)
+
+    return max(1, int(memory_budget // bytes_per_bank))
+
+
+def candidate_recall(candidates, reference):
+    """
+    Mean share of reference rtk (rows of column indices, e.g. top 100 of full scoring)
+    found in candidate sets of the same banks, and share of banks with first reference kept.
+    """
+
+    hits = np.array([np.isin(ref, cand) for ref, cand in zip(reference, candidates)])
+
+    return hits.mean(), hits[:, 0].mean()
@@ -0,0 +1,90 @@
+"""
+Columnar on-disk store of aggregates: one npy file per column and json manifest.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+MANIFEST = 'manifest.json'
+
+
+def save_aggregates(data, path):
+    """Save dict of aggregated DataFrames to directory, one subdirectory per aggregate."""
+
+    os.makedirs(path, exist_ok=True)
+    manifest = {}
+    for key, df in data.items():
+        table_path = os.path.join(path, key)
+        os.makedirs(table_path, exist_ok=True)
+        index_names = list(df.index.names) if has_named_index(df) else []
+        manifest[key] = {
+            'index': [save_column(df.index.get_level_values(i), table_path, f'index_{i}')
+                      for i in range(len(index_names))],
+            'index_names': index_names,
+            'columns': [save_column(df.iloc[:, i], table_path, str(i))
+                        for i in range(df.shape[1])],
+            'column_names': df.columns.tolist(),
+            'columns_name': df.columns.name}
+
+    with open(os.path.join(path, MANIFEST), 'w') as file_:
+        json.dump(manifest, file_, indent=1)
+
+
+def load_aggregates(path, keys=None):
+    """Load only given aggregates (all if keys is None)."""
+
+    with open(os.path.join(path, MANIFEST)) as file_:
+        manifest = json.load(file_)
+    if keys is None:
+        keys = list(manifest)
+
+    return {key: load_table(os.path.join(path, key), manifest[key]) for key in keys}
+
+
+def load_table(table_path, table_manifest):
+
+    columns = [load_column(table_path, column) for column in table_manifest['columns']]
+    df = pd.DataFrame(dict(enumerate(columns)))
+    df.columns = pd.Index(table_manifest['column_names'], name=table_manifest['columns_name'])
+
+    if table_manifest['index_names']:
+        index = [load_column(table_path, column) for column in table_manifest['index']]
+        if len(index) > 1:
+            df.index = pd.MultiIndex.from_arrays(index, names=table_manifest['index_names'])
+        else:
+            df.index = pd.Index(index[0], name=table_manifest['index_names'][0])
+
+    return df
+
+
+def save_column(values, table_path, name):
+    """Save column as npy array, object columns are dictionary encoded."""
+
+    if values.dtype == object:
+        codes, categories = pd.factorize(values)
+        np.save(os.path.join(table_path, f'{name}.codes.npy'), codes.astype('int32'))
+        np.save(os.path.join(table_path, f'{name}.categories.npy'), categories.values.astype('U'))
+        return {'name': name, 'encoding': 'dictionary'}
+
+    np.save(os.path.join(table_path, f'{name}.npy'), np.asarray(values))
+    return {'name': name, 'encoding': 'plain'}
+
+
+def load_column(table_path, column):
+
+    name = column['name']
+    if column['encoding'] == 'dictionary':
+        codes = np.load(os.path.join(table_path, f'{name}.codes.npy'))
+        categories = np.load(os.path.join(table_path, f'{name}.categories.npy'))
+        return categories.astype(object)[codes]
+
+    return np.load(os.path.join(table_path, f'{name}.npy'))
+
+
+def has_named_index(df):
+
+    return any(name is not None for name in df.index.names)
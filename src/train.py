@@ -2,88 +2,109 @@
 Train model.
 """
 
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from copy import copy
 
+import catboost
 import numpy as np
-import pandas as pd
 from catboost import CatBoostClassifier, CatBoostRanker, Pool
 from sklearn.model_selection import train_test_split
 
 from eval import calc_metrics, make_predictions
 from sample import sample_negative_examples
+from scoring import feature_matrix
+
+
+# float32 feature matrices of banks and rtk with their ids in rows order
+FeatureTables = namedtuple('FeatureTables', ['banks', 'trans', 'rtks', 'click'])
+
+# catboost params used for quantization of pools instead of fit
+QUANTIZATION_PARAMS = ['border_count', 'max_bin', 'feature_border_type', 'nan_mode',
+                       'per_float_feature_quantization']
+# catboost versions (pinned and checked) where pools are quantized with thread_count
+# by private Pool._quantize taking dict of params, other versions use Pool.quantize
+THREADED_QUANTIZE_VERSIONS = ('1.0.', '1.2.')
 
  
 def training_with_resampling(train, test, df_trans, df_click, catboost_params,
                              sample_size, validation=False, resample_freq=1000, 
-                             random_state=42, thread_count=20, plot=False, verbose=False):
+                             random_state=42, thread_count=20, plot=False, verbose=False,
+                             prefetch=True, reuse_borders=True):
 
     catboost_params  = copy(catboost_params)
     num_iterations = int(np.ceil(catboost_params['iterations']/resample_freq)) - 1
     catboost_params['iterations'] = resample_freq
 
-    if validation:
-        train, val = train_test_split(train, test_size=0.1, random_state=42)
+    # borders are selected on the first round pool and other pools are quantized with them
+    quantization_params = {}
+    if reuse_borders:
+        quantization_params = {key: catboost_params.pop(key) for key in QUANTIZATION_PARAMS
+                               if key in catboost_params}
+        quantization_params['random_seed'] = catboost_params.get('random_seed')
 
-        val = sample_negative_examples(
-            val, sample_size=sample_size, random_state=random_state)
-        val = pd.merge(val, df_trans, left_on='bank', right_index=True)
-        val = pd.merge(val, df_click, left_on='rtk', right_index=True)
-        val = val.sort_values('bank')
+    # features are converted once, every round only gathers rows of sampled pairs
+    tables = FeatureTables(df_trans.index, feature_matrix(df_trans, df_trans.index),
+                           df_click.index, feature_matrix(df_click, df_click.index))
 
-        yval = val.target.values
-        queries_val = val.bank.values
-        Xval = val.drop(['bank', 'rtk', 'target'], axis=1).values
+    if validation:
+        train, val = train_test_split(train, test_size=0.1, random_state=42)
+        validation_pool = sampled_pool(val, tables, sample_size, random_state,
+                                       thread_count=thread_count)
 
-    train2 = train.copy()
-    train2 = sample_negative_examples(
-        train2, sample_size=sample_size, random_state=random_state)
-    train2 = pd.merge(train2, df_trans, left_on='bank', right_index=True)
-    train2 = pd.merge(train2, df_click, left_on='rtk', right_index=True)
-    train2 = train2.sort_values('bank')
+    # pools copy their data, so all rounds are gathered to one buffer
+    # large enough for all positives and sampled negatives
+    buffer = np.empty((len(train) * (sample_size + 1),
+                       tables.trans.shape[1] + tables.click.shape[1]), dtype='float32')
 
-    ytrain = train2.target.values
-    queries_train = train2.bank.values
-    Xtrain = train2.drop(['bank', 'rtk', 'target'], axis=1).values
+    # round i samples negatives with random_state + i, with prefetch pool
+    # of the next round is built in background thread while current one is fitted
+    seeds = [random_state + i for i in range(num_iterations + 1)]
+    clf = CatBoostRanker(thread_count=thread_count, **catboost_params)
 
-    train_pool = Pool(data=Xtrain, label=ytrain, group_id=queries_train)
-    if validation:
-        validation_pool = Pool(data=Xval, label=yval, group_id=queries_val)
-        print('train shape', Xtrain.shape, 'validation shape', Xval.shape)
-    else:
-        print('train shape', Xtrain.shape)
+    # borders file is kept in temporary directory removed after prefetch thread is joined
+    borders_context = tempfile.TemporaryDirectory() if reuse_borders else nullcontext()
+    with borders_context as borders_dir, ThreadPoolExecutor(1) as executor:
+
+        borders = os.path.join(borders_dir, 'borders.tsv') if reuse_borders else None
+        next_pool = None
+        for i, seed in enumerate(seeds):
+
+            if i > 0:
+                print(f'Iteration {i}')
+            if i == 0 and reuse_borders:
+                train_pool = sampled_pool(train, tables, sample_size, seed, buffer,
+                                          thread_count=thread_count)
+                quantize_pool(train_pool, thread_count, **quantization_params)
+                train_pool.save_quantization_borders(borders)
+                if validation:
+                    quantize_pool(validation_pool, thread_count, input_borders=borders)
+            elif next_pool is None:
+                train_pool = sampled_pool(train, tables, sample_size, seed, buffer, borders,
+                                          thread_count)
+            else:
+                train_pool = next_pool.result()
+            if prefetch and i + 1 < len(seeds):
+                next_pool = executor.submit(sampled_pool, train, tables, sample_size,
+                                            seeds[i + 1], buffer, borders, thread_count)
+
+            if validation:
+                print('train shape', pool_shape(train_pool),
+                      'validation shape', pool_shape(validation_pool))
+            else:
+                print('train shape', pool_shape(train_pool))
+
+            init_model = clf if i > 0 else None
+            if validation:
+                clf.fit(train_pool, eval_set=validation_pool, plot=plot,
+                        verbose=verbose, init_model=init_model)
+            else:
+                clf.fit(train_pool, plot=plot, verbose=verbose, init_model=init_model)
+            del train_pool
 
-    clf = CatBoostRanker(thread_count=thread_count, **catboost_params)
-    if validation:
-        clf.fit(train_pool, eval_set=validation_pool, plot=plot, verbose=verbose)
-    else:
-        clf.fit(train_pool, plot=plot, verbose=verbose)
-
-    for i in range(num_iterations):
-
-        print(f'Iteration {i+1}')
-        train2 = train.copy()
-        train2 = sample_negative_examples(
-            train2, sample_size=sample_size, random_state=random_state + 1 + i)
-        train2 = pd.merge(train2, df_trans, left_on='bank', right_index=True)
-        train2 = pd.merge(train2, df_click, left_on='rtk', right_index=True)
-        train2 = train2.sort_values('bank')
-
-        ytrain = train2.target.values
-        queries_train = train2.bank.values
-        Xtrain = train2.drop(['bank', 'rtk', 'target'], axis=1).values
-
-        train_pool = Pool(data=Xtrain, label=ytrain, group_id=queries_train)
-        if validation:
-            print('train shape', Xtrain.shape, 'validation shape', Xval.shape)
-        else:
-            print('train shape', Xtrain.shape)
-        
-        if validation:
-            clf.fit(train_pool, eval_set=validation_pool, plot=plot,
-                    verbose=verbose, init_model=clf)
-        else:
-            clf.fit(train_pool, plot=plot, verbose=verbose, init_model=clf)
-    
     if test is None:
         return clf
     else:
@@ -93,3 +114,56 @@ def training_with_resampling(train, test, df_trans, df_click, catboost_params,
                    'best_iteration': clf.best_iteration_}
 
         return clf, metrics, preds
+
+
+def sampled_pool(data, tables, sample_size, random_state, out=None, borders=None,
+                 thread_count=-1):
+    """
+    Pool of data pairs with sampled negatives, pairs are grouped by bank and pairs with
+    bank or rtk missing in feature tables are dropped. If out is given, features
+    are gathered to its first rows. If borders file is given, pool is quantized with it.
+    Pool is built and quantized with at most thread_count threads.
+    """
+
+    data = sample_negative_examples(data, sample_size=sample_size, random_state=random_state)
+    bank_rows = tables.banks.get_indexer(data.bank)
+    rtk_rows = tables.rtks.get_indexer(data.rtk)
+    found = np.flatnonzero((bank_rows != -1) & (rtk_rows != -1))
+    order = found[np.argsort(bank_rows[found], kind='stable')]
+
+    num_trans = tables.trans.shape[1]
+    if out is None:
+        out = np.empty((len(order), num_trans + tables.click.shape[1]), dtype='float32')
+    X = out[:len(order)]
+    np.take(tables.trans, bank_rows[order], axis=0, out=X[:, :num_trans], mode='clip')
+    np.take(tables.click, rtk_rows[order], axis=0, out=X[:, num_trans:], mode='clip')
+
+    pool = Pool(data=X, label=data.target.values[order], group_id=bank_rows[order],
+                thread_count=thread_count)
+    if borders is not None:
+        quantize_pool(pool, thread_count, input_borders=borders)
+
+    return pool
+
+
+def quantize_pool(pool, thread_count=-1, **params):
+    """
+    Quantize pool with at most thread_count threads. Pool.quantize does not accept
+    thread_count, so for THREADED_QUANTIZE_VERSIONS params are passed to underlying
+    quantization like Pool.quantize does, otherwise all threads are used.
+    """
+
+    params = {key: value for key, value in params.items() if value is not None}
+    # max_bin is synonym of border_count, border_count takes precedence as in Pool.quantize
+    if 'max_bin' in params:
+        params.setdefault('border_count', params.pop('max_bin'))
+
+    if thread_count > 0 and catboost.__version__.startswith(THREADED_QUANTIZE_VERSIONS):
+        pool._quantize({**params, 'thread_count': thread_count})
+    else:
+        pool.quantize(**params)
+
+
+def pool_shape(pool):
+
+    return pool.num_row(), pool.num_col()
@@ -1,157 +1,414 @@
 import gc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 
 
-def aggregate_transactions(transactions_path):
+# user ids are read as categorical and events are aggregated by integer codes,
+# ids are decoded only in partial states
+TRANSACTIONS_DTYPE = {'user_id': 'category', 'mcc_code': 'int16', 'currency_rk': 'int16',
+                      'transaction_amt': 'float32'}
+CLICKSTREAM_DTYPE = {'user_id': 'category', 'cat_id': 'int16', 'new_uid': 'int32'}
+# sign of transaction amount is coded as 0 (negative) or 1 (positive)
+SIGNS = np.array(['negative', 'positive'], dtype=object)
 
-    transactions = pd.read_csv(transactions_path,
-                               dtype={'mcc_code': 'int16',
-                                      'currency_rk': 'int16',
-                                      'transaction_amt': 'float32'})
-    
-    transactions['sign'] = (transactions.transaction_amt > 0).map({
-        True: 'positive', False: 'negative'})
-    transactions['datetime'] = pd.to_datetime(transactions.transaction_dttm)
-    transactions['week'] = transactions.datetime.dt.weekofyear
-    transactions['date'] = transactions.datetime.dt.date
-    transactions['hour'] = transactions.datetime.dt.hour
+# length in minutes of time feature buckets, all of them consist of whole time slots
+TIME_BUCKETS = {'hour': 60, '45min': 45, '90min': 90}
+TIME_SLOT = 15
 
-    transactions['minute'] = transactions.datetime.dt.minute
-    transactions['minute'] = transactions['hour'] * 60 + transactions['minute']
-    transactions['45min'] = transactions.minute // 45
-    transactions['90min'] = transactions.minute // 90
 
-    transactions_grouped = transactions.groupby(['user_id', 'mcc_code', 'currency_rk', 'sign']) \
-        .transaction_amt.agg(['count', 'sum', 'mean'])
+def aggregate_transactions(transactions_path, chunksize=None):
+    """
+    Aggregate transactions. If chunksize is given file is read in chunks
+    and only mergeable partial state is kept in memory.
+    Amount sums are then accumulated chunk by chunk, so they can differ
+    from single pass in the last float32 digits.
+    """
+
+    state = None
+    for transactions in read_events(transactions_path, TRANSACTIONS_DTYPE,
+                                    'transaction_dttm', chunksize):
+        state = merge_states(state, transactions_state(transactions))
+        del transactions
+        gc.collect()
+
+    return finalize_transactions(state)
+
+
+def transactions_state(transactions):
+    """Partial state of transactions aggregates for one chunk of data."""
+
+    transactions['user_id'], users = encode_users(transactions.user_id)
+    transactions['sign'] = (transactions.transaction_amt > 0).astype('int8')
+
+    grouped = transactions.groupby(['user_id', 'mcc_code', 'currency_rk', 'sign']) \
+        .transaction_amt.agg(['count', 'sum'])
+
+    by_week = transactions.groupby(['user_id', 'mcc_code', 'sign', 'week']) \
+        .transaction_amt.agg(['count', 'sum'])
+
+    date = transactions.drop_duplicates(['user_id', 'mcc_code', 'sign', 'date'])
+    date = date[['user_id', 'mcc_code', 'sign', 'date']].reset_index(drop=True)
+
+    time = transactions.drop_duplicates(['user_id', 'sign', 'date', 'slot'])
+    time = time[['user_id', 'sign', 'date', 'slot']].reset_index(drop=True)
+
+    return {key: decode_users(frame, users) for key, frame in
+            {'grouped': grouped, 'by_week': by_week, 'date': date, 'time': time}.items()}
+
+
+def finalize_transactions(state):
+
+    transactions_grouped = state['grouped']
+    transactions_grouped['mean'] = (transactions_grouped['sum'].astype('float64') /
+                                    transactions_grouped['count']).astype('float32')
     transactions_grouped = transactions_grouped.reset_index()
 
-    transactions_week = transactions.drop_duplicates(['user_id', 'mcc_code', 'sign', 'week'])
+    transactions_week = state['by_week'].index.to_frame(index=False)
     transactions_grouped_week = transactions_week.groupby(['user_id', 'mcc_code', 'sign']).size()
     transactions_grouped_week = transactions_grouped_week.rename('count')
     transactions_grouped_week = transactions_grouped_week.reset_index()
 
-    transactions_date = transactions.drop_duplicates(['user_id', 'mcc_code', 'sign', 'date'])
+    transactions_date = state['date']
     transactions_grouped_date = transactions_date.groupby(['user_id', 'mcc_code', 'sign']).size()
     transactions_grouped_date = transactions_grouped_date.rename('count')
     transactions_grouped_date = transactions_grouped_date.reset_index()
 
-    transactions_weekly_normed = agg_trans_weekly_normed(transactions)
-
-    transactions_hour = time_features(transactions, column='hour',
-                                      prefix='trans_hour', add_total_count=True)
-    transactions_hour_neg = time_features(transactions[transactions.sign == 'negative'],
-                                          column='hour', prefix='trans_neg_hour',
-                                          add_total_count=True)
-    transactions_hour_pos = time_features(transactions[transactions.sign == 'positive'],
-                                          column='hour', prefix='trans_pos_hour',
-                                          add_total_count=True)
-    transactions_45min = time_features(transactions, column='45min',
-                                       prefix='trans_45min', add_total_count=True) 
-    transactions_90min = time_features(transactions, column='90min',
-                                       prefix='trans_90min', add_total_count=True)                                   
-
-    del transactions, transactions_week, transactions_date
+    transactions_weekly_normed = agg_trans_weekly_normed(state['by_week'])
+
+    transactions_time = time_features(state['time'], [
+        ('hour', 'hour', 'trans_hour', None),
+        ('hour_neg', 'hour', 'trans_neg_hour', 'negative'),
+        ('hour_pos', 'hour', 'trans_pos_hour', 'positive'),
+        ('45min', '45min', 'trans_45min', None),
+        ('90min', '90min', 'trans_90min', None)], add_total_count=True)
+
+    del transactions_week, transactions_date, state
     gc.collect()
 
     return {'grouped': transactions_grouped,
             'grouped_week': transactions_grouped_week,
             'grouped_date': transactions_grouped_date,
             'weekly_normed': transactions_weekly_normed,
-            'hour': transactions_hour,
-            'hour_neg': transactions_hour_neg,
-            'hour_pos': transactions_hour_pos,
-            '45min': transactions_45min,
-            '90min': transactions_90min}
+            **transactions_time}
 
 
-def agg_trans_weekly_normed(transactions):
+def agg_trans_weekly_normed(transactions_by_week):
+    """
+    Shares of mcc codes in count and sum of user transactions of each sign and week,
+    summed over weeks and divided by total number of weeks. Shares are computed
+    on long format, weeks where sum is zero give no share of sum.
+    """
 
-    total_num_weeks = transactions.week.nunique()
-    transactions_by_week = transactions.groupby(['user_id', 'mcc_code', 'sign', 'week']) \
-        .transaction_amt.agg(['count', 'sum'])
+    total_num_weeks = transactions_by_week.index.get_level_values('week').nunique()
 
-    counts = transactions_by_week['count'].unstack(level='mcc_code')
-    counts = counts.divide(counts.sum(axis=1), axis=0)
-    counts = counts.stack()
-    counts = counts.reset_index().groupby(['user_id', 'mcc_code', 'sign'])[0].sum()/total_num_weeks
-    counts = counts.rename('count').to_frame()
+    by_week = transactions_by_week.reset_index()
+    weeks = by_week.groupby(['user_id', 'sign', 'week'], sort=False)[['count', 'sum']]
+    shares = by_week[['count', 'sum']] / weeks.transform('sum')
+    shares[['user_id', 'mcc_code', 'sign']] = by_week[['user_id', 'mcc_code', 'sign']]
 
-    sums = transactions_by_week['sum'].unstack(level='mcc_code')
-    sums = sums.divide(sums.sum(axis=1), axis=0)
-    sums = sums.stack()
-    sums = sums.reset_index().groupby(['user_id', 'mcc_code', 'sign'])[0].sum()/total_num_weeks
-    sums = sums.rename('sum')
+    transactions_weekly_normed = shares.groupby(['user_id', 'mcc_code', 'sign']) \
+        .sum(min_count=1)/total_num_weeks
 
-    transactions_weekly_normed = counts.join(sums).reset_index()
+    return transactions_weekly_normed.reset_index()
 
-    return transactions_weekly_normed
 
+def aggregate_clickstream(clickstream_path, chunksize=None):
+    """
+    Aggregate clickstream. If chunksize is given file is read in chunks
+    and only mergeable partial state is kept in memory.
+    """
 
-def aggregate_clickstream(clickstream_path):
+    state = None
+    for clickstream in read_events(clickstream_path, CLICKSTREAM_DTYPE,
+                                   'timestamp', chunksize):
+        state = merge_states(state, clickstream_state(clickstream))
+        del clickstream
+        gc.collect()
 
-    clickstream = pd.read_csv(clickstream_path,
-                              dtype={'cat_id': 'int16', 'new_uid': 'int32'})
+    return finalize_clickstream(state)
 
-    clickstream['datetime'] = pd.to_datetime(clickstream.timestamp)
-    clickstream['week'] = clickstream.datetime.dt.weekofyear
-    clickstream['date'] = clickstream.datetime.dt.date
-    clickstream['hour'] = clickstream.datetime.dt.hour
 
-    clickstream['minute'] = clickstream.datetime.dt.minute
-    clickstream['minute'] = clickstream['hour'] * 60 + clickstream['minute']
-    clickstream['45min'] = clickstream.minute // 45
-    clickstream['90min'] = clickstream.minute // 90
+def clickstream_state(clickstream):
+    """Partial state of clickstream aggregates for one chunk of data."""
 
-    clickstream_week = clickstream.drop_duplicates(['user_id', 'cat_id', 'week'])
+    clickstream['user_id'], users = encode_users(clickstream.user_id)
+
+    date = clickstream.drop_duplicates(['user_id', 'cat_id', 'date'])
+    date = date[['user_id', 'cat_id', 'date', 'week']].reset_index(drop=True)
+
+    time = clickstream.drop_duplicates(['user_id', 'date', 'slot'])
+    time = time[['user_id', 'date', 'slot']].reset_index(drop=True)
+
+    return {'date': decode_users(date, users), 'time': decode_users(time, users)}
+
+
+def finalize_clickstream(state):
+
+    clickstream_date = state['date']
+
+    clickstream_week = clickstream_date.drop_duplicates(['user_id', 'cat_id', 'week'])
     clickstream_grouped_week = clickstream_week.groupby(['user_id', 'cat_id']).size()
     clickstream_grouped_week = clickstream_grouped_week.reset_index()
 
-    clickstream_date = clickstream.drop_duplicates(['user_id', 'cat_id', 'date'])
     clickstream_grouped_date = clickstream_date.groupby(['user_id', 'cat_id']).size()
     clickstream_grouped_date = clickstream_grouped_date.reset_index()
 
     clickstream_weekly_normed = agg_click_weekly_normed(clickstream_date)
 
-    clickstream_hour = time_features(clickstream, column='hour',
-                                     prefix='click_hour', add_total_count=True)
-    clickstream_45min = time_features(clickstream, column='45min',
-                                      prefix='click_45min', add_total_count=True)
-    clickstream_90min = time_features(clickstream, column='90min',
-                                      prefix='click_90min', add_total_count=True)
+    clickstream_time = time_features(state['time'], [
+        ('hour', 'hour', 'click_hour', None),
+        ('45min', '45min', 'click_45min', None),
+        ('90min', '90min', 'click_90min', None)], add_total_count=True)
 
-    del clickstream, clickstream_week, clickstream_date
+    del clickstream_week, clickstream_date, state
     gc.collect()
 
     return {'grouped_week': clickstream_grouped_week.reset_index(),
             'grouped_date': clickstream_grouped_date,
             'weekly_normed': clickstream_weekly_normed,
-            'hour': clickstream_hour,
-            '45min': clickstream_45min,
-            '90min': clickstream_90min}
+            **clickstream_time}
 
 
 def agg_click_weekly_normed(clickstream_date):
+    """
+    Shares of categories in user clicks of each week, summed over weeks
+    and divided by total number of weeks.
+    """
 
     total_num_weeks = clickstream_date.week.nunique()
     clickstream_by_week = clickstream_date.groupby(['user_id', 'cat_id', 'week']).size()
+    clickstream_by_week = clickstream_by_week.reset_index()
 
-    counts = clickstream_by_week.unstack(level='cat_id')
-    counts = counts.divide(counts.sum(axis=1), axis=0)
-    counts = counts.stack()
-    counts = counts.reset_index().groupby(['user_id', 'cat_id'])[0].sum()/total_num_weeks
+    weeks = clickstream_by_week.groupby(['user_id', 'week'], sort=False)[0]
+    clickstream_by_week[0] = clickstream_by_week[0] / weeks.transform('sum')
+    counts = clickstream_by_week.groupby(['user_id', 'cat_id'])[0].sum()/total_num_weeks
 
     return counts.reset_index()
 
 
-def time_features(df, column='hour', prefix='trans_hour', add_total_count=True):
+def aggregate_parallel(transactions_path, clickstream_path, n_jobs=4, chunksize=None):
+    """
+    Aggregate transactions and clickstream with pool of n_jobs processes.
+
+    Data is sharded by user_id hash, so all rows of each user are processed
+    by one worker and results are the same as of aggregate_transactions and
+    aggregate_clickstream. States of shards are merged in submission order and
+    at most 2 * n_jobs shards are in flight, so with chunksize memory is still
+    bounded by chunk size. Transactions are finalized while clickstream is aggregated.
+    """
+
+    if n_jobs <= 1:
+        return (aggregate_transactions(transactions_path, chunksize),
+                aggregate_clickstream(clickstream_path, chunksize))
+
+    sources = [(transactions_path, TRANSACTIONS_DTYPE, 'transaction_dttm',
+                transactions_state, finalize_transactions),
+               (clickstream_path, CLICKSTREAM_DTYPE, 'timestamp',
+                clickstream_state, finalize_clickstream)]
+
+    with ProcessPoolExecutor(n_jobs) as executor:
+
+        results = []
+        for path, dtype, time_column, state_func, finalize_func in sources:
+            state = None
+            for shard_state in sharded_states(executor, read_chunks(path, dtype, chunksize),
+                                              time_column, state_func, n_jobs):
+                state = merge_states(state, shard_state)
+            results.append(executor.submit(finalize_func, state))
+            del state
+            gc.collect()
+
+        return tuple(result.result() for result in results)
+
+
+def sharded_states(executor, chunks, time_column, state_func, n_jobs):
+    """
+    States of user shards of chunks computed in executor, yielded in submission order.
+    At most 2 * n_jobs shards are pending, next chunk is read only after
+    states of earlier shards are collected.
+    """
+
+    pending = deque()
+    for chunk in chunks:
+        for shard in shard_by_user(chunk, n_jobs):
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+            pending.append(executor.submit(events_state, shard, time_column, state_func))
+        del chunk
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def shard_by_user(df, num_shards):
+
+    shards = pd.util.hash_array(df.user_id.values) % num_shards
+    for i in range(num_shards):
+        shard = df[shards == i]
+        if len(shard) > 0:
+            yield shard
+
+
+def events_state(events, time_column, state_func):
+
+    decode_events(events, time_column)
+    return state_func(events)
+
+
+def read_events(path, dtype, time_column, chunksize=None):
+    """Read csv file (in chunks if chunksize is given) and decode timestamps."""
+
+    for chunk in read_chunks(path, dtype, chunksize):
+        decode_events(chunk, time_column)
+        yield chunk
+
+
+def read_chunks(path, dtype, chunksize=None):
+
+    if chunksize is None:
+        yield pd.read_csv(path, dtype=dtype)
+    else:
+        yield from pd.read_csv(path, dtype=dtype, chunksize=chunksize)
+
+
+def decode_events(events, time_column):
+    """Replace timestamp column with integer time codes inplace."""
+
+    for column, values in decode_timestamps(events.pop(time_column)).items():
+        events[column] = values
+
+
+def merge_states(state, other):
+    """
+    Merge partial states computed on different chunks of data.
+    Grouped aggregates (indexed by group keys) are summed,
+    sets of distinct keys are deduplicated.
+    """
+
+    if state is None:
+        return other
+    if other is None:
+        return state
+
+    merged = {}
+    for key, frame in state.items():
+        frame = pd.concat([frame, other[key]])
+        if isinstance(frame.index, pd.MultiIndex):
+            frame = frame.groupby(level=frame.index.names).sum()
+        else:
+            frame = frame.drop_duplicates(ignore_index=True)
+        merged[key] = frame
+
+    return merged
+
+
+def decode_timestamps(timestamps):
+    """
+    Parse timestamps once and derive integer time codes from epoch seconds.
+
+    Returns dict with day number since epoch ('date'), ISO week number ('week')
+    and TIME_SLOT minutes time slot of the day ('slot').
+    """
+
+    seconds = pd.to_datetime(timestamps).values.astype('int64') // 10**9
+    days, seconds_of_day = np.divmod(seconds, 86400)
+    slot = (seconds_of_day // (60 * TIME_SLOT)).astype('uint8')
+
+    # ISO week is the week of the year containing Thursday of the given week,
+    # 1970-01-01 (day 0) was Thursday
+    thursday = days - (days + 3) % 7 + 3
+    thursday = thursday.astype('datetime64[D]')
+    year_start = thursday.astype('datetime64[Y]').astype('datetime64[D]')
+    week = (thursday - year_start).astype('int64') // 7 + 1
+
+    return {'date': days.astype('int16'),
+            'week': week.astype('int8'),
+            'slot': slot}
+
+
+def encode_users(user_id):
+    """Int32 codes of user ids and array of ids, codes are in sorted order of ids."""
+
+    if not isinstance(user_id.dtype, pd.CategoricalDtype):
+        user_id = user_id.astype('category')
+    categories = user_id.cat.categories
+    codes = user_id.cat.codes.values.astype('int32')
+    if not categories.is_monotonic_increasing:
+        order = categories.argsort()
+        ranks = np.empty(len(order), dtype='int32')
+        ranks[order] = np.arange(len(order))
+        codes = ranks[codes]
+        categories = categories[order]
+
+    return codes, np.asarray(categories, dtype=object)
+
+
+def decode_users(frame, users):
+    """Replace user codes and sign codes (if any) of state frame with user ids and sign names."""
+
+    if isinstance(frame.index, pd.MultiIndex):
+        # codes are in sorted order of decoded values, so only index levels are replaced
+        # levels are passed as lists, so empty levels of empty chunks are not ambiguous
+        index = frame.index
+        index = index.set_levels([users[index.levels[index.names.index('user_id')]]],
+                                 level=['user_id'])
+        if 'sign' in index.names:
+            index = index.set_levels([SIGNS[index.levels[index.names.index('sign')]]],
+                                     level=['sign'])
+        frame.index = index
+    else:
+        frame['user_id'] = users[frame.user_id.values]
+        if 'sign' in frame:
+            frame['sign'] = SIGNS[frame.sign.values]
+
+    return frame
+
+
+def time_features(df, features, add_total_count=True):
+    """
+    Compute time histograms in one pass over distinct (user, sign, date, time slot) rows.
+
+    For each feature (name, column, prefix, sign) count number of distinct dates
+    when user was active in each time bucket (hour, 45min or 90min) and normalize
+    by user total. If sign is not None only rows with given sign are used.
+    """
+
+    user_codes, users = pd.factorize(df.user_id, sort=True)
+    user_codes = user_codes.astype('int64')
+    days = df.date.values - df.date.values.min()
+    num_days = days.max() + 1
+
+    res = {}
+    for name, column, prefix, sign in features:
+
+        num_buckets = -(-24 * 60 // TIME_BUCKETS[column])
+        idx = slice(None) if sign is None else (df.sign == sign).values
+        buckets = df.slot.values[idx] // (TIME_BUCKETS[column] // TIME_SLOT)
+
+        keys = (user_codes[idx] * num_days + days[idx]) * num_buckets + buckets
+        keys = np.unique(keys)
+        user_buckets = keys // (num_days * num_buckets) * num_buckets + keys % num_buckets
+        counts = np.bincount(user_buckets, minlength=len(users) * num_buckets)
+        counts = counts.reshape(len(users), num_buckets)
+
+        rows = counts.any(axis=1)
+        columns = np.flatnonzero(counts.any(axis=0))
+        counts = counts[rows][:, columns]
+        total_count = counts.sum(axis=1)
+        if (counts == 0).any():
+            # same dtype as for unstack with filled missing buckets
+            total_count = total_count.astype('float64')
+
+        features_df = pd.DataFrame(
+            counts / total_count[:, None],
+            index=pd.Index(users[rows], name='user_id'),
+            columns=pd.Index([f'{prefix}_{x}' for x in columns], name=column))
+        if add_total_count:
+            features_df[f'{prefix}_total'] = total_count
+        res[name] = features_df
 
-    df = df.drop_duplicates(['user_id', column, 'date'])
-    res = df.groupby(['user_id', column]).size().unstack().fillna(0)
-    res.columns = res.columns.map(lambda x: f'{prefix}_{x}')
-    total_count = res.sum(axis=1)
-    res = res.divide(total_count, axis=0)
-    if add_total_count:
-        res[f'{prefix}_total'] = total_count
-    
     return res
+
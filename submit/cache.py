@@ -0,0 +1,160 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from aggregate import (CLICKSTREAM_DTYPE, TIME_BUCKETS, TIME_SLOT, TRANSACTIONS_DTYPE,
+                       clickstream_state, events_state, finalize_clickstream,
+                       finalize_transactions, merge_states, read_chunks, sharded_states,
+                       transactions_state)
+from store import MANIFEST, load_aggregates, save_aggregates
+
+
+# bump to invalidate all caches when state computation changes
+CACHE_VERSION = 2
+
+
+def aggregate_cached(transactions_path, clickstream_path, cache_path, n_jobs=4,
+                     chunksize=None, max_users=None):
+    """
+    Aggregate transactions and clickstream, state of users whose raw rows are
+    the same as in previous runs is taken from cache and only other users are aggregated.
+    Cache keeps at most max_users least recently used users of each source.
+    """
+
+    transactions_state_ = cached_state(
+        transactions_path, TRANSACTIONS_DTYPE, 'transaction_dttm', transactions_state,
+        cache_path, n_jobs, chunksize, max_users)
+    clickstream_state_ = cached_state(
+        clickstream_path, CLICKSTREAM_DTYPE, 'timestamp', clickstream_state,
+        cache_path, n_jobs, chunksize, max_users)
+
+    return finalize_transactions(transactions_state_), finalize_clickstream(clickstream_state_)
+
+
+def cached_state(path, dtype, time_column, state_func, cache_path, n_jobs=4,
+                 chunksize=None, max_users=None):
+    """State of events in path with cache of per-user state, cache is updated."""
+
+    # cache directory depends on everything state is computed from
+    settings = repr((CACHE_VERSION, state_func.__name__, dtype, TIME_SLOT, TIME_BUCKETS))
+    cache_path = os.path.join(cache_path, hashlib.md5(settings.encode()).hexdigest()[:12])
+
+    chunks = read_chunks(path, dtype, chunksize)
+    if chunksize is None:
+        # whole file is kept instead of reading it twice
+        chunks = list(chunks)
+    users, fingerprints = user_fingerprints(chunks)
+
+    cache = None
+    cached_users = pd.DataFrame({'user_id': np.array([], dtype=object),
+                                 'fingerprint': np.array([], dtype='uint64'),
+                                 'last_used': np.array([], dtype='int64')})
+    if os.path.exists(os.path.join(cache_path, MANIFEST)):
+        cache = load_aggregates(cache_path)
+        cached_users = cache.pop('users')
+    positions = pd.Index(users).get_indexer(cached_users.user_id.values)
+    same = (positions != -1) & (fingerprints[positions] == cached_users.fingerprint.values)
+    valid = cached_users.user_id.values[same]
+    changed = users[~pd.Index(users).isin(valid)]
+    print(f'{path}: {len(users) - len(changed)} cached users, {len(changed)} to aggregate')
+
+    if chunksize is not None:
+        chunks = read_chunks(path, dtype, chunksize)
+    new_state = users_state((chunk[chunk.user_id.isin(changed)].copy() for chunk in chunks),
+                            time_column, state_func, n_jobs)
+    state = merge_states(select_users(cache, valid), new_state)
+
+    # users of this run are the most recently used ones, least recently used are evicted
+    tick = cached_users.last_used.max() + 1 if len(cached_users) else 0
+    cached_users = pd.concat([
+        cached_users[~cached_users.user_id.isin(users)],
+        pd.DataFrame({'user_id': users, 'fingerprint': fingerprints,
+                      'last_used': np.full(len(users), tick, dtype='int64')})],
+        ignore_index=True)
+    if max_users is not None and len(cached_users) > max_users:
+        cached_users = cached_users.sort_values('last_used', kind='stable').iloc[-max_users:]
+        cached_users = cached_users.reset_index(drop=True)
+
+    kept_users = cached_users.user_id[~cached_users.user_id.isin(users)].values
+    cache = merge_states(select_users(cache, kept_users),
+                         select_users(state, cached_users.user_id.values))
+    save_cache(cache_path, {'users': cached_users, **cache})
+
+    return state
+
+
+def user_fingerprints(chunks):
+    """
+    Users and fingerprints of their raw rows, fingerprint is sum of row hashes,
+    so it does not depend on rows order and on splitting file into chunks.
+    """
+
+    users, hashes = [], []
+    for chunk in chunks:
+        chunk_users, chunk_hashes = sum_by_user(
+            chunk.user_id.values, pd.util.hash_pandas_object(chunk, index=False).values)
+        users.append(chunk_users)
+        hashes.append(chunk_hashes)
+
+    return sum_by_user(np.concatenate(users), np.concatenate(hashes))
+
+
+def sum_by_user(users, hashes):
+    """Sorted unique users and sums of their uint64 hashes modulo 2**64."""
+
+    codes, unique_users = pd.factorize(users, sort=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+
+    return np.asarray(unique_users, dtype=object), np.add.reduceat(hashes[order], starts)
+
+
+def users_state(chunks, time_column, state_func, n_jobs=4):
+    """
+    State of events of given chunks, with n_jobs > 1 chunks are sharded by user
+    and at most 2 * n_jobs shards are in flight.
+    """
+
+    state = None
+    if n_jobs <= 1:
+        for chunk in chunks:
+            if len(chunk):
+                state = merge_states(state, events_state(chunk, time_column, state_func))
+        return state
+
+    with ProcessPoolExecutor(n_jobs) as executor:
+        for shard_state in sharded_states(executor, chunks, time_column, state_func, n_jobs):
+            state = merge_states(state, shard_state)
+
+    return state
+
+
+def select_users(state, users):
+    """Rows of state frames of given users."""
+
+    if state is None:
+        return None
+
+    selected = {}
+    for key, frame in state.items():
+        if isinstance(frame.index, pd.MultiIndex):
+            rows = frame.index.get_level_values('user_id').isin(users)
+        else:
+            rows = frame.user_id.isin(users)
+        selected[key] = frame[rows]
+
+    return selected
+
+
+def save_cache(cache_path, cache):
+    """Save cache, old one is replaced only after new one is fully written."""
+
+    save_aggregates(cache, f'{cache_path}.tmp')
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(f'{cache_path}.tmp', cache_path)
+
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+
+import numpy as np
+from catboost import CatBoostClassifier, CatBoostRanker
+
+
+BACKENDS = ['catboost', 'onnx']
+
+# loaded models are cached by (path, rank, backend, thread_count) across calls
+_MODELS = {}
+
+
+def load_model(path, rank=True, backend='catboost', thread_count=-1):
+    """
+    Load model from cbm file for given inference backend:
+    - catboost: CatBoost model, predict on numpy arrays
+    - onnx: model is exported from cbm file once and evaluated with onnxruntime
+    """
+
+    key = (path, rank, backend, thread_count)
+    if key in _MODELS:
+        return _MODELS[key]
+
+    clf = CatBoostRanker() if rank else CatBoostClassifier()
+    clf.load_model(path)
+
+    if backend == 'onnx':
+        import onnxruntime
+
+        onnx_path = os.path.splitext(path)[0] + '.onnx'
+        if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(path):
+            clf.save_model(onnx_path, format='onnx')
+        options = onnxruntime.SessionOptions()
+        if thread_count > 0:
+            options.intra_op_num_threads = thread_count
+        model = onnxruntime.InferenceSession(onnx_path, options)
+    elif backend == 'catboost':
+        model = clf
+    else:
+        raise ValueError(f'unknown backend {backend}')
+
+    _MODELS[key] = model
+
+    return model
+
+
+def predict(model, X, rank=True, backend='catboost', thread_count=-1, ntree_end=0):
+    """
+    Scores of model for float32 C-contiguous feature matrix X,
+    if ntree_end > 0 only first ntree_end trees are used (catboost backend).
+    """
+
+    if backend == 'onnx':
+        if ntree_end > 0:
+            raise ValueError('ntree_end is not supported for onnx backend')
+        outputs = model.run(None, {model.get_inputs()[0].name: X})
+        if rank:
+            return outputs[0].ravel().astype('float64')
+        # classifier probabilities are exported as list of {class: probability} dicts
+        return np.array([probabilities[1] for probabilities in outputs[1]], dtype='float64')
+
+    if rank:
+        return model.predict(X, ntree_end=ntree_end, thread_count=thread_count)
+    return model.predict_proba(X, ntree_end=ntree_end, thread_count=thread_count)[:, 1]
+
+
+def benchmark(model_paths, rank, num_rows=200000, backends=None, thread_count=-1,
+              random_state=42):
+    """Rows/sec of ensemble inference on random float32 features for every backend."""
+
+    if backends is None:
+        backends = BACKENDS
+
+    rng = np.random.default_rng(random_state)
+    results = {}
+    for backend in backends:
+        models = [load_model(path, rank[i], backend, thread_count)
+                  for i, path in enumerate(model_paths)]
+        if backend == 'onnx':
+            num_features = [model.get_inputs()[0].shape[1] for model in models]
+        else:
+            num_features = [len(model.feature_names_) for model in models]
+        data = [rng.random((num_rows, n), dtype='float32') for n in num_features]
+
+        start_time = time.time()
+        for model, X, is_rank in zip(models, data, rank):
+            predict(model, X, is_rank, backend, thread_count)
+        results[backend] = num_rows / (time.time() - start_time)
+        print(f'{backend}: {results[backend]:.0f} rows/sec')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    from run import RANK
+
+    # python inference.py [num_rows] [thread_count]
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    thread_count = int(sys.argv[2]) if len(sys.argv) > 2 else -1
+    benchmark([f'data/model_{i+1}.cbm' for i in range(len(RANK))], RANK,
+              num_rows=num_rows, thread_count=thread_count)
@@ -0,0 +1,106 @@
+from collections import namedtuple
+
+import numpy as np
+
+from scoring import top_k
+
+
+# time histograms of both sources share buckets, so banks and rtk are embedded
+# in one space and compared by cosine similarity
+EMBEDDING_BUCKETS = {'hour': 24, '45min': 32, '90min': 16}
+
+# inverted file: vectors row positions grouped by nearest centroid,
+# rows of list i are order[offsets[i]:offsets[i+1]]
+IVFIndex = namedtuple('IVFIndex', ['centroids', 'vectors', 'order', 'offsets'])
+
+
+def time_embeddings(data, prefix, ids, buckets=EMBEDDING_BUCKETS):
+    """
+    L2-normalized float32 concatenation of time histograms of ids (trans or click prefix)
+    from aggregates dict, users without events get zero vectors.
+    """
+
+    blocks = []
+    for column, num_buckets in buckets.items():
+        columns = [f'{prefix}_{column}_{x}' for x in range(num_buckets)]
+        block = data[column].reindex(index=ids, columns=columns)
+        blocks.append(block.fillna(0).to_numpy(dtype='float32'))
+    vectors = np.hstack(blocks)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+    return vectors
+
+
+def exact_neighbours(queries, vectors, k, block_size=1024):
+    """Row positions of k most similar vectors for every query by blocked matmul."""
+
+    k = min(k, len(vectors))
+    res = np.empty((len(queries), k), dtype='int64')
+    for start in range(0, len(queries), block_size):
+        scores = queries[start:start + block_size] @ vectors.T
+        res[start:start + block_size] = top_k(scores, k)
+
+    return res
+
+
+def fit_centroids(vectors, num_lists, num_iter=20, random_state=42):
+    """Spherical k-means centroids of non zero vectors."""
+
+    vectors = vectors[np.linalg.norm(vectors, axis=1) > 0]
+    rng = np.random.default_rng(random_state)
+    num_lists = min(num_lists, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+
+    for _ in range(num_iter):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # empty lists keep their previous centroid
+        np.divide(sums, norms, out=centroids, where=norms > 0)
+
+    return centroids
+
+
+def build_ivf(centroids, vectors):
+    """Assign vectors to lists of nearest centroids."""
+
+    assignment = np.argmax(vectors @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.zeros(len(centroids) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(centroids)))
+
+    return IVFIndex(centroids, vectors, order, offsets)
+
+
+def ivf_neighbours(index, queries, k, num_probe=8):
+    """
+    Row positions of k most similar vectors for every query among vectors of
+    num_probe nearest lists, more lists are probed while there are less than k candidates.
+    """
+
+    k = min(k, len(index.vectors))
+    sizes = np.diff(index.offsets)
+    list_order = np.argsort(-(queries @ index.centroids.T), axis=1, kind='stable')
+
+    res = np.empty((len(queries), k), dtype='int64')
+    for i, query in enumerate(queries):
+        num_lists = max(num_probe, np.searchsorted(np.cumsum(sizes[list_order[i]]), k) + 1)
+        candidates = np.concatenate([index.order[index.offsets[j]:index.offsets[j + 1]]
+                                     for j in list_order[i, :num_lists]])
+        scores = index.vectors[candidates] @ query
+        res[i] = candidates[top_k(scores[None, :], k)[0]]
+
+    return res
+
+
+def save_centroids(path, centroids):
+
+    np.save(path, centroids.astype('float32'))
+
+
+def load_centroids(path):
+
+    return np.load(path)
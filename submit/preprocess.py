@@ -1,4 +1,12 @@
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+
+
+# sparse user x feature matrix with row (user_id) and column (feature names) indexes
+SparseBlock = namedtuple('SparseBlock', ['matrix', 'index', 'columns'])
 
 
 def click_preprocess(clickstream, click_categories,
@@ -6,7 +14,8 @@ def click_preprocess(clickstream, click_categories,
                      level_1=False, level_2=False,
                      filter_count=0, normed=True):
 
-    clicks = pd.merge(clickstream, click_categories)
+    if level_0 or level_1 or level_2:
+        clicks = pd.merge(clickstream, click_categories)
     df_click = []
 
     if cat_id:
@@ -25,27 +34,27 @@ def click_preprocess(clickstream, click_categories,
         df = group_clicks(clicks, 'level_2', filter_count, normed)
         df_click.append(df)
 
-    return pd.concat(df_click, axis=1)
+    return to_frame(concat_blocks(df_click))
 
 
 def group_clicks(clicks, column='cat_id', filter_count=10, normed=False):
 
     df = clicks.groupby(['user_id', column])[0].sum()
-    df = df.unstack().fillna(0)
-    df.columns = df.columns.map(lambda x: f'{column}-{x}')
+    df = pivot_sparse(df)
+    df = rename_columns(df, lambda x: f'{column}-{x}')
     if filter_count > 0:
         df = column_filter(df, filter_count)
     if normed:
-        df = df.divide(df.sum(axis=1), axis=0)
+        df = normalize_rows(df)
         
     return df
 
 
 def column_filter(df, filter_count):
     
-    column_count = (df != 0).sum(axis=0)
-    use_columns = column_count[column_count >= filter_count].index
-    df = df[use_columns]
+    column_count = df.matrix.getnnz(axis=0)
+    use_columns = np.flatnonzero(column_count >= filter_count)
+    df = SparseBlock(df.matrix[:, use_columns], df.index, df.columns[use_columns])
     
     return df
 
@@ -80,7 +89,7 @@ def trans_preprocess(transactions, counts=True, sums=False, sign='combined',
     else:
         raise ValueError
 
-    return pd.concat(df_trans, axis=1)
+    return to_frame(concat_blocks(df_trans))
 
 
 def group_counts_and_sums(transactions, counts=True, sums=False,
@@ -91,12 +100,12 @@ def group_counts_and_sums(transactions, counts=True, sums=False,
     if counts:
         df = group_transactions(transactions, 'count', filter_count, normed)
         if postfix is not None:
-            df.columns = df.columns.map(lambda x: f'{x}-{postfix}')
+            df = rename_columns(df, lambda x: f'{x}-{postfix}')
         df_trans.append(df)
     if sums:
         df = group_transactions(transactions, 'sum', filter_count, normed)
         if postfix is not None:
-            df.columns = df.columns.map(lambda x: f'{x}-{postfix}')
+            df = rename_columns(df, lambda x: f'{x}-{postfix}')
         df_trans.append(df)
         
     return df_trans
@@ -105,21 +114,108 @@ def group_counts_and_sums(transactions, counts=True, sums=False,
 def group_transactions(transactions, column='count', filter_count=10, normed=False):
 
     df = transactions.groupby(['user_id', 'mcc_code'])[column].sum()
-    df = df.unstack().fillna(0)
-    df.columns = df.columns.map(lambda x: f'{column}-mcc{x}')
+    df = pivot_sparse(df)
+    df = rename_columns(df, lambda x: f'{column}-mcc{x}')
     if filter_count > 0:
         df = column_filter(df, filter_count)
     if normed:
-        df = df.divide(df.sum(axis=1), axis=0)
+        df = normalize_rows(df)
         
     return df
 
 
-def filter_features(df, features_list):
+def pivot_sparse(series):
+    """Sparse analogue of series.unstack().fillna(0) for (user_id, key) indexed series."""
 
-    for feature in features_list:
-        if feature not in df.columns:
-            df[feature] = 0
-    
-    return df[features_list]
+    rows, index = pd.factorize(series.index.get_level_values(0), sort=True)
+    columns, column_values = pd.factorize(series.index.get_level_values(1), sort=True)
+    values = series.values
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype('float64')
+
+    matrix = sp.csr_matrix((values, (rows, columns)),
+                           shape=(len(index), len(column_values)))
+    matrix.eliminate_zeros()
+    column_values = pd.Index(column_values, name=series.index.names[1])
+
+    return SparseBlock(matrix, index.rename(series.index.names[0]), column_values)
+
+
+def rename_columns(df, mapper):
+
+    return SparseBlock(df.matrix, df.index, df.columns.map(mapper))
+
+
+def normalize_rows(df):
+    """Divide rows by their sums, rows with zero sum become NaN (or inf) as in dense division."""
+
+    matrix = df.matrix.tocsr(copy=True)
+    row_sums = dense_row_sums(matrix)
+    zero_rows = row_sums == 0
+    matrix.data /= np.repeat(np.where(zero_rows, 1, row_sums), np.diff(matrix.indptr))
+
+    if zero_rows.any():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dense_rows = df.matrix[zero_rows].toarray() / 0
+        matrix = set_rows(matrix, np.flatnonzero(zero_rows), dense_rows)
+
+    return SparseBlock(matrix, df.index, df.columns)
+
+
+def dense_row_sums(matrix, chunksize=10000):
+    """Row sums in the same summation order as for dense matrix, densified by chunks of rows."""
+
+    return np.concatenate([matrix[i:(i + chunksize)].toarray().sum(axis=1)
+                           for i in range(0, matrix.shape[0], chunksize)])
+
+
+def concat_blocks(blocks):
+    """
+    Sparse analogue of pd.concat(axis=1): blocks are aligned to union of their rows,
+    rows missing in a block are filled with NaN. Aligned blocks are returned separately,
+    so every block keeps its dtype.
+    """
+
+    index = blocks[0].index
+    for block in blocks[1:]:
+        index = index.union(block.index, sort=False)
+
+    aligned = []
+    for block in blocks:
+        positions = index.get_indexer(block.index)
+        matrix = sp.csr_matrix((len(index), block.matrix.shape[1]), dtype=block.matrix.dtype)
+        matrix = set_rows(matrix, positions, block.matrix)
+        missing = np.setdiff1d(np.arange(len(index)), positions)
+        if len(missing) > 0:
+            nans = np.full((len(missing), block.matrix.shape[1]), np.nan, dtype=block.matrix.dtype)
+            matrix = set_rows(matrix, missing, nans)
+        aligned.append(SparseBlock(matrix, index, block.columns))
+
+    return aligned
+
+
+def set_rows(matrix, rows, values):
+    """Return copy of csr matrix with given rows replaced by values (sparse or dense)."""
+
+    keep = np.ones(matrix.shape[0], dtype=bool)
+    keep[rows] = False
+    values = sp.coo_matrix(values)
+
+    result = matrix.tocoo()
+    result = sp.coo_matrix(
+        (np.concatenate([result.data[keep[result.row]], values.data]),
+         (np.concatenate([result.row[keep[result.row]], np.asarray(rows)[values.row]]),
+          np.concatenate([result.col[keep[result.row]], values.col]))),
+        shape=matrix.shape)
+
+    return result.tocsr()
+
+
+def to_frame(blocks):
+    """Convert aligned sparse blocks to DataFrame with sparse columns of blocks dtypes."""
+
+    res = pd.concat([pd.DataFrame.sparse.from_spmatrix(block.matrix, index=block.index,
+                                                       columns=block.columns)
+                     for block in blocks], axis=1)
 
+    return res
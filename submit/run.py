@@ -1,12 +1,18 @@
 import pickle
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-from catboost import CatBoostClassifier, CatBoostRanker
 
-from aggregate import aggregate_clickstream, aggregate_transactions
-from preprocess import click_preprocess, filter_features, trans_preprocess
+from aggregate import aggregate_parallel
+from cache import aggregate_cached
+from inference import load_model, predict
+from neighbours import build_ivf, ivf_neighbours, load_centroids, time_embeddings
+from preprocess import click_preprocess, trans_preprocess
+from scoring import (batch_size_for_budget, candidate_recall, feature_matrix,
+                     pair_buffer, pair_features, top_k)
 
 
 WEIGHTS = None
@@ -37,125 +43,266 @@ CLICK_TIME_FEATURES = [['hour'], ['45min'], ['hour'], ['90min'], ['hour']]
 TRANS_TIME_FEATURES = [['hour'], ['45min'], ['hour_pos', 'hour_neg'], ['90min'], ['hour'] ]
 
 CLICK_CATEGORIES_PATH = 'data/click_categories.csv'
+# number of csv rows per chunk for aggregation, None to read whole files at once
+CHUNKSIZE = None
+# number of processes for aggregation
+N_JOBS = 4
+# directory of per-user aggregation state cache, only users with changed rows are
+# aggregated on repeated runs, None to aggregate all users, at most
+# AGGREGATION_CACHE_MAX_USERS least recently used users of each source are kept
+AGGREGATION_CACHE_PATH = None
+AGGREGATION_CACHE_MAX_USERS = None
+# memory in bytes for scoring batch, ROWS_PER_BATCH (bank, rtk) pairs per batch if set
+MEMORY_BUDGET = 2 * 1024**3
+ROWS_PER_BATCH = None
+# number of models scored concurrently in threads and CatBoost threads per model
+N_WORKERS = 5
+THREAD_COUNT = 4
+# inference backend: catboost or onnx (requires onnxruntime)
+BACKEND = 'catboost'
+# two stage scoring: RETRIEVAL_TOP_K candidates per bank are selected for full ensemble,
+# None to score all pairs. Candidates are selected by first RETRIEVAL_TREES trees of
+# model RETRIEVAL_MODEL ('model') or by nearest time of activity histograms ('time_index')
+RETRIEVAL_TOP_K = None
+RETRIEVAL = 'model'
+RETRIEVAL_MODEL = 0
+RETRIEVAL_TREES = 500
+# centroids fitted by build_index.py and number of probed lists of time index
+TIME_INDEX_PATH = 'data/time_index.npy'
+TIME_INDEX_PROBE = 8
 
  
 def main():
 
     data_path, output_path = sys.argv[1:]
 
-    df_click_list, df_trans_list = prepare_features(data_path)
+    (list_of_rtk, click_features, list_of_bank, trans_features,
+     embeddings) = prepare_features(data_path)
     clf_list = load_models()
-    submission = make_predictions(clf_list, df_click_list, df_trans_list)
+    submission = make_predictions(clf_list, list_of_rtk, click_features,
+                                  list_of_bank, trans_features, embeddings)
     np.savez(output_path, submission)
 
 
 def prepare_features(data_path):
 
-    clickstream_data = aggregate_clickstream(f'{data_path}/clickstream.csv')
-    transactions_data = aggregate_transactions(f'{data_path}/transactions.csv')
+    if AGGREGATION_CACHE_PATH is None:
+        transactions_data, clickstream_data = aggregate_parallel(
+            f'{data_path}/transactions.csv', f'{data_path}/clickstream.csv', N_JOBS, CHUNKSIZE)
+    else:
+        transactions_data, clickstream_data = aggregate_cached(
+            f'{data_path}/transactions.csv', f'{data_path}/clickstream.csv',
+            AGGREGATION_CACHE_PATH, N_JOBS, CHUNKSIZE, AGGREGATION_CACHE_MAX_USERS)
     
     click_categories = pd.read_csv(CLICK_CATEGORIES_PATH)
     click_categories.fillna('NaN', inplace=True)
 
-    df_click_list = []
-    df_trans_list = []
+    # models with the same data and params share one preprocessed feature node,
+    # every node is computed once and models join their time features to it
+    click_nodes = feature_nodes(CLICK_DATA, CLICK_PARAMS)
+    trans_nodes = feature_nodes(TRANS_DATA, TRANS_PARAMS)
+
+    df_click_nodes = {i: click_preprocess(clickstream_data[CLICK_DATA[i]], click_categories,
+                                          **CLICK_PARAMS[i])
+                      for i in sorted(set(click_nodes))}
+    df_trans_nodes = {i: trans_preprocess(transactions_data[TRANS_DATA[i]], **TRANS_PARAMS[i])
+                      for i in sorted(set(trans_nodes))}
+    print('click feature nodes', len(df_click_nodes), 'trans feature nodes', len(df_trans_nodes))
+
+    # candidates are users of the first model features
+    list_of_rtk = list(df_click_nodes[click_nodes[0]].index)
+    list_of_bank = list(df_trans_nodes[trans_nodes[0]].index)
+
+    # compile features of every model once to float32 matrices with saved columns order
+    # and rows in order of list_of_rtk / list_of_bank, so scoring only gathers rows
+    click_features_list = []
+    trans_features_list = []
     for i in range(len(CLICK_PARAMS)):
 
-        df_click = click_preprocess(
-            clickstream_data[CLICK_DATA[i]],  click_categories, **CLICK_PARAMS[i])
+        df_click = df_click_nodes[click_nodes[i]]
         for feature_group in CLICK_TIME_FEATURES[i]:
             df_click = df_click.join(clickstream_data[feature_group])
         with open(f"data/click_features_{i+1}.pkl", "rb") as file_:
             click_features = pickle.load(file_)
-        df_click = filter_features(df_click, click_features)
-        df_click_list.append(df_click)
+        click_features = feature_matrix(df_click, list_of_rtk, click_features)
+        click_features_list.append(click_features)
 
-        df_trans = trans_preprocess(transactions_data[TRANS_DATA[i]], **TRANS_PARAMS[i])
+        df_trans = df_trans_nodes[trans_nodes[i]]
         for feature_group in TRANS_TIME_FEATURES[i]:
             df_trans = df_trans.join(transactions_data[feature_group])
         with open(f"data/trans_features_{i+1}.pkl", "rb") as file_:
             trans_features = pickle.load(file_)
-        df_trans = filter_features(df_trans, trans_features)
-        df_trans_list.append(df_trans)
+        trans_features = feature_matrix(df_trans, list_of_bank, trans_features)
+        trans_features_list.append(trans_features)
 
-        print('df_click', df_click.shape, 'df_trans', df_trans.shape)
+        print('click features', click_features.shape, 'trans features', trans_features.shape)
 
-    return df_click_list, df_trans_list
+    # time of activity embeddings of banks and rtk for time index retrieval
+    embeddings = None
+    if RETRIEVAL_TOP_K is not None and RETRIEVAL == 'time_index':
+        embeddings = (time_embeddings(transactions_data, 'trans', list_of_bank),
+                      time_embeddings(clickstream_data, 'click', list_of_rtk))
+
+    return list_of_rtk, click_features_list, list_of_bank, trans_features_list, embeddings
+
+
+def feature_nodes(data, params):
+    """For every model index of the first model with the same data and params."""
+
+    specs = [(data[i], sorted(params[i].items())) for i in range(len(data))]
+
+    return [specs.index(spec) for spec in specs]
 
 
 def load_models():
 
     clf_list = []
     for i in range(len(RANK)):
-        if RANK[i]:
-            clf = CatBoostRanker()
-        else:
-            clf = CatBoostClassifier()
-        clf.load_model(f'data/model_{i+1}.cbm')
+        clf = load_model(f'data/model_{i+1}.cbm', RANK[i], BACKEND, THREAD_COUNT)
         clf_list.append(clf)
 
     return clf_list
 
 
-def make_predictions(clf_list, df_click_list, df_trans_list):
-
-    list_of_rtk = list(df_click_list[0].index)
-    list_of_bank= list(df_trans_list[0].index)
+def make_predictions(clf_list, list_of_rtk, click_features, list_of_bank, trans_features,
+                     embeddings=None):
+
+    widths = [trans_features[i].shape[1] + click_features[i].shape[1]
+              for i in range(len(clf_list))]
+    retrieval = RETRIEVAL_TOP_K is not None and RETRIEVAL_TOP_K < len(list_of_rtk)
+    num_candidates = RETRIEVAL_TOP_K if retrieval else len(list_of_rtk)
+    # with model retrieval its buffer of all pairs is alive together with ensemble
+    # buffers of candidates, so both stages share memory budget
+    retrieval_stages = []
+    if retrieval and RETRIEVAL == 'model':
+        retrieval_stages = [(len(list_of_rtk), [widths[RETRIEVAL_MODEL]])]
+    batch_size = batch_size_for_budget(num_candidates, widths, MEMORY_BUDGET, ROWS_PER_BATCH,
+                                       retrieval_stages)
+    if retrieval and RETRIEVAL == 'model':
+        # first stage scores all pairs with one model
+        retrieval_clf = load_model(f'data/model_{RETRIEVAL_MODEL+1}.cbm',
+                                   RANK[RETRIEVAL_MODEL], 'catboost', THREAD_COUNT)
+        retrieval_buffer = pair_buffer(trans_features[RETRIEVAL_MODEL],
+                                       click_features[RETRIEVAL_MODEL], batch_size)
+
+        def retrieve(bank_rows):
+            return retrieve_candidates(retrieval_clf, trans_features[RETRIEVAL_MODEL],
+                                       click_features[RETRIEVAL_MODEL], bank_rows,
+                                       retrieval_buffer)
+
+    elif retrieval and RETRIEVAL == 'time_index':
+        bank_vectors, rtk_vectors = embeddings
+        index = build_ivf(load_centroids(TIME_INDEX_PATH), rtk_vectors)
+
+        def retrieve(bank_rows):
+            return ivf_neighbours(index, bank_vectors[bank_rows], RETRIEVAL_TOP_K,
+                                  TIME_INDEX_PROBE)
+
+    elif retrieval:
+        raise ValueError(f'unknown retrieval {RETRIEVAL}')
+    num_of_batches = int((len(list_of_bank))/batch_size)+1
+    print('batch size', batch_size, 'banks')
 
-    submission = pd.DataFrame(list_of_bank, columns=['bank'])
-    submission['rtk'] = submission['bank'].apply(lambda x: list_of_rtk)
+    # zero rtk candidate is always ranked first
+    candidates = np.array(list_of_rtk + [0.], dtype=object)
+    scores = np.empty((batch_size, num_candidates + 1))
+    scores[:, -1] = 1000
+    final_submission = np.empty((len(list_of_bank), 2), dtype=object)
 
-    batch_size = 20
-    num_of_batches = int((len(list_of_bank))/batch_size)+1
-    final_submission = []
+    with ThreadPoolExecutor(N_WORKERS) as executor:
 
-    for n in range(num_of_batches):
+        if retrieval:
+            # recall is measured before ensemble buffers are allocated on banks
+            # for which full scoring fits in memory budget with retrieval buffer
+            num_banks = min(batch_size, len(list_of_bank), batch_size_for_budget(
+                len(list_of_rtk), widths, MEMORY_BUDGET, ROWS_PER_BATCH, retrieval_stages))
+            bank_rows = np.arange(num_banks)
+            report_retrieval_recall(executor, clf_list, click_features, trans_features,
+                                    bank_rows, retrieve(bank_rows))
 
-        bank_ids = list_of_bank[(n*batch_size):((n+1)*batch_size)]
+        buffers = [pair_buffer(trans_features[i], click_features[i], batch_size, num_candidates)
+                   for i in range(len(clf_list))]
 
-        if len(bank_ids) != 0:
+        for n in range(num_of_batches):
 
-            submission_part = submission[submission.bank.isin(bank_ids)].explode('rtk')
+            bank_ids = list_of_bank[(n*batch_size):((n+1)*batch_size)]
 
-            probas = []
-            for i in range(len(clf_list)):
-                submission_part_i = submission_part \
-                    .merge(df_trans_list[i], how='left', left_on='bank', right_index=True) \
-                    .merge(df_click_list[i], how='left', left_on='rtk', right_index=True)
+            if len(bank_ids) != 0:
 
-                Xtest = submission_part_i.drop(['bank', 'rtk'], axis=1).values
-                if RANK[i]:
-                    proba = clf_list[i].predict(Xtest)
-                else:
-                    proba = clf_list[i].predict_proba(Xtest)[:, 1]
-                probas.append(proba)
+                start_time = time.time()
+                bank_rows = np.arange(n*batch_size, n*batch_size + len(bank_ids))
 
-            probas = np.array(probas)
-            if WEIGHTS is None:
-                submission_part['proba'] = np.mean(probas, axis=0)
-            else:
-                submission_part['proba'] = (probas.T * WEIGHTS).sum(axis=1)
+                rtk_rows = retrieve(bank_rows) if retrieval else None
 
-            zeros_part = pd.DataFrame(bank_ids, columns=['bank'])
-            zeros_part['rtk'] = 0.
-            zeros_part['proba'] = 1000
+                batch_scores = scores[:len(bank_ids)]
+                batch_scores[:, :-1] = ensemble_scores(executor, clf_list, click_features,
+                                                       trans_features, bank_rows, buffers,
+                                                       rtk_rows)
 
-            submission_part = pd.concat((submission_part, zeros_part))
+                top = top_k(batch_scores, 100)
+                if retrieval:
+                    # map candidate positions to rtk positions, last one is zero rtk
+                    rtk_rows = np.hstack((rtk_rows, np.full((len(bank_ids), 1), len(list_of_rtk))))
+                    top = np.take_along_axis(rtk_rows, top, axis=1)
+                for row, j in zip(bank_rows, np.argsort(bank_ids, kind='stable')):
+                    final_submission[row, 0] = bank_ids[j]
+                    final_submission[row, 1] = candidates[top[j]].tolist()
 
-            submission_part = submission_part.sort_values(
-                by=['bank', 'proba'], ascending=False).reset_index(drop=True)
-            submission_part = submission_part.pivot_table(index='bank', values='rtk', aggfunc=list)
-            submission_part['rtk'] = submission_part['rtk'].apply(lambda x: x[:100])
-            submission_part = submission_part.reset_index()
-            final_submission.append(submission_part)
+                num_rows = len(bank_ids) * num_candidates
+                print(f'batch {n+1}/{num_of_batches}: {num_rows} rows, '
+                      f'{num_rows / (time.time() - start_time):.0f} rows/sec')
 
-    final_submission = pd.concat(final_submission)
-    final_submission = np.array(final_submission, dtype=object)
     print(final_submission.shape)
 
     return final_submission
 
 
+def ensemble_scores(executor, clf_list, click_features, trans_features, bank_rows, buffers,
+                    rtk_rows=None):
+    """Ensemble scores of (num_banks, num_candidates) pairs."""
+
+    # CatBoost releases GIL during predict, so models are scored in parallel
+    futures = [executor.submit(predict_model, clf_list[i], RANK[i], trans_features[i],
+                               click_features[i], bank_rows, buffers[i], rtk_rows)
+               for i in range(len(clf_list))]
+    probas = np.array([future.result() for future in futures])
+    if WEIGHTS is None:
+        proba = np.mean(probas, axis=0)
+    else:
+        proba = (probas.T * WEIGHTS).sum(axis=1)
+
+    return proba.reshape(len(bank_rows), -1)
+
+
+def predict_model(clf, rank, trans_features, click_features, bank_rows, buffer, rtk_rows=None):
+
+    Xtest = pair_features(trans_features, click_features, bank_rows, buffer, rtk_rows)
+
+    return predict(clf, Xtest, rank, BACKEND, THREAD_COUNT)
+
+
+def retrieve_candidates(clf, trans_features, click_features, bank_rows, buffer):
+    """Rtk rows of RETRIEVAL_TOP_K best candidates for every bank by truncated model."""
+
+    Xtest = pair_features(trans_features, click_features, bank_rows, buffer)
+    scores = predict(clf, Xtest, RANK[RETRIEVAL_MODEL], 'catboost', THREAD_COUNT,
+                     ntree_end=min(RETRIEVAL_TREES, clf.tree_count_))
+
+    return top_k(scores.reshape(len(bank_rows), -1), RETRIEVAL_TOP_K)
+
+
+def report_retrieval_recall(executor, clf_list, click_features, trans_features,
+                            bank_rows, rtk_rows):
+    """Compare retrieved candidates of given banks with top 100 of full scoring."""
+
+    buffers = [None] * len(clf_list)
+    full_top = top_k(ensemble_scores(executor, clf_list, click_features, trans_features,
+                                     bank_rows, buffers), 100)
+    recall, top1_recall = candidate_recall(rtk_rows, full_top)
+    print(f'{RETRIEVAL} retrieval recall@{RETRIEVAL_TOP_K} of full top 100 '
+          f'on {len(bank_rows)} banks: {recall:.4f}, top 1 kept: {top1_recall:.4f}')
+
+
 if __name__ == "__main__":
 
     main()